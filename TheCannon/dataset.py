@@ -34,12 +34,38 @@ else:
     basestring = (str, unicode)
 
 
+def _as_array(arr):
+    """ Pass an array through; load a .npy filename as a read-only memmap
+
+    Letting the big flux/ivar blocks stay on disk means np.load with
+    mmap_mode='r' only pages in the pixels actually touched, so survey
+    test sets larger than RAM can still be processed.
+
+    Parameters
+    ----------
+    arr: ndarray or str
+        the array itself, or the path of a .npy file holding it
+
+    Returns
+    -------
+    arr: ndarray
+        the array, memory-mapped if it was given as a path
+    """
+    if isinstance(arr, basestring):
+        return np.load(arr, mmap_mode='r')
+    return arr
+
+
 class Dataset(object):
     """ A class to represent Cannon input: a dataset of spectra and labels """
 
     def __init__(self, wl, tr_ID, tr_flux, tr_ivar, tr_label, test_ID, test_flux, test_ivar):
         """ Initiate a Dataset object
 
+        The flux and ivar blocks can each be given as the path of a .npy
+        file instead of an array; they are then memory-mapped rather than
+        read into RAM.
+
         Parameters
         ----------
         wl: grid of wavelength values, onto which all spectra are mapped
@@ -55,20 +81,20 @@ class Dataset(object):
         print("This may take a while...")
         self.wl = wl
         self.tr_ID = tr_ID
-        self.tr_flux = tr_flux
-        self.tr_ivar = tr_ivar
+        self.tr_flux = _as_array(tr_flux)
+        self.tr_ivar = _as_array(tr_ivar)
         self.tr_label = tr_label
         self.test_ID = test_ID
-        self.test_flux = test_flux
-        self.test_ivar = test_ivar
+        self.test_flux = _as_array(test_flux)
+        self.test_ivar = _as_array(test_ivar)
         self._label_names = None
         self.ranges = None
         
         # calculate SNR
         self.tr_SNR = np.array(
-                [self._SNR(*s) for s in zip(tr_flux, tr_ivar)])
+                [self._SNR(*s) for s in zip(self.tr_flux, self.tr_ivar)])
         self.test_SNR = np.array(
-                [self._SNR(*s) for s in zip(test_flux, test_ivar)])
+                [self._SNR(*s) for s in zip(self.test_flux, self.test_ivar)])
 
 
     def _SNR(self, flux, ivar):
@@ -116,6 +142,25 @@ class Dataset(object):
             return self._label_names
 
 
+    def remove_stars(self, mask):
+        """ Discard flagged training objects from the dataset
+
+        Parameters
+        ----------
+        mask: ndarray of bool
+            True corresponds to a star that should be removed
+        """
+        keep = np.logical_not(mask)
+        print("Removing %s stars" % np.sum(mask))
+        self.tr_ID = self.tr_ID[keep]
+        # np.compress maps a boolean mask straight to a C loop, with no
+        # intermediate index array for the big flux blocks
+        self.tr_flux = np.compress(keep, self.tr_flux, axis=0)
+        self.tr_ivar = np.compress(keep, self.tr_ivar, axis=0)
+        self.tr_label = self.tr_label[keep]
+        self.tr_SNR = self.tr_SNR[keep]
+
+
     def bin_flux(flux, ivar):
         """ bin two neighboring flux values """
         if np.sum(ivar)==0:
@@ -426,9 +471,7 @@ class Dataset(object):
             test_vals = test_labels[:,i]
             warning = np.logical_or(test_vals < lower[i], test_vals > upper[i])
             filename = "flagged_stars_%s.txt" % i
-            with open(filename, 'w') as output:
-                for star in test_IDs[warning]:
-                    output.write('{0:s}\n'.format(star))
+            np.savetxt(filename, test_IDs[warning], fmt='%s')
             print("Reference label %s" % label_name)
             print("flagged %s stars beyond 2-sig of ref labels" % sum(warning))
             print("Saved list %s" % filename)
@@ -494,7 +537,9 @@ class Dataset(object):
                     fontsize=14)
             ax2.legend(fontsize=14)
             figname_full = "%s_%s.png" %(figname, i)
-            plt.savefig(figname_full)
+            # lighter zlib compression encodes the PNG several times
+            # faster for a negligible size cost
+            plt.savefig(figname_full, pil_kwargs={'compress_level': 3})
             print("Diagnostic for label output vs. input")
             print("Saved fig %s" % figname_full)
             plt.close()
@@ -5,6 +5,25 @@ import numpy as np
 import matplotlib.pyplot as plt
 from TheCannon import train_model
 
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+# upper-triangle index arrays, cached per nlabels so that
+# np.triu_indices is not rebuilt on every _get_lvec call
+_TRIU_CACHE = {}
+
+def _triu(nlabels):
+    """ Return cached np.triu_indices(nlabels) index arrays """
+    if nlabels not in _TRIU_CACHE:
+        i_idx, j_idx = np.triu_indices(nlabels)
+        _TRIU_CACHE[nlabels] = (np.asarray(i_idx, dtype=np.intp),
+                                np.asarray(j_idx, dtype=np.intp))
+    return _TRIU_CACHE[nlabels]
+
+
 def _get_lvec(labels):
     """
     Constructs a label vector for an arbitrary number of labels
@@ -20,18 +39,15 @@ def _get_lvec(labels):
     lvec: numpy ndarray
         label vector
     """
-    nlabels = len(labels)
+    labels = np.asarray(labels)
     # specialized to second-order model
-    linear_terms = labels 
-    quadratic_terms = np.outer(linear_terms, 
-                               linear_terms)[np.triu_indices(nlabels)]
-    lvec = np.hstack((linear_terms, quadratic_terms))
-    return lvec
+    i_idx, j_idx = _triu(len(labels))
+    return np.concatenate((labels, labels[i_idx]*labels[j_idx]))
 
 
 def _func(coeffs, *labels):
-    """ Takes the dot product of coefficients vec & labels vector 
-    
+    """ Takes the dot product of coefficients vec & labels vector
+
     Parameters
     ----------
     coeffs: numpy ndarray
@@ -48,6 +64,304 @@ def _func(coeffs, *labels):
     return np.dot(coeffs, lvec)
 
 
+def _make_func(nlabels):
+    """ Build a model-evaluation callback for curve_fit
+
+    The closure captures the cached upper-triangle indices and a
+    preallocated label-vector buffer, so each evaluation is two
+    gathers, one multiply and one dot product -- no per-call
+    np.hstack or list conversion.
+
+    Parameters
+    ----------
+    nlabels: int
+        number of labels in the model
+
+    Returns
+    -------
+    func: callable
+        func(coeffs, *labels) -> model flux values
+    """
+    i_idx, j_idx = _triu(nlabels)
+    buf = np.empty(nlabels + len(i_idx))
+
+    def func(coeffs, *labels):
+        lab = np.asarray(labels)
+        buf[:nlabels] = lab
+        np.multiply(lab[i_idx], lab[j_idx], out=buf[nlabels:])
+        return coeffs.dot(buf)
+
+    return func
+
+
+def _get_lvec_all(labels_all, triu_i, triu_j):
+    """ Constructs label vectors for a block of stars at once
+
+    Assumes that our model is quadratic in the labels
+
+    Parameters
+    ----------
+    labels_all: numpy ndarray, shape (nstars, nlabels)
+        pivoted label values for all stars
+
+    triu_i, triu_j: numpy ndarray
+        upper-triangle index arrays from np.triu_indices(nlabels)
+
+    Returns
+    -------
+    lvec_all: numpy ndarray, shape (nstars, nterms)
+        label vector for each star
+    """
+    return np.concatenate(
+            (labels_all, labels_all[:,triu_i] * labels_all[:,triu_j]), axis=1)
+
+
+def _get_dlvec_all(labels_all, triu_i, triu_j):
+    """ Analytic derivatives of the label vectors wrt the labels
+
+    For the quadratic term l_i*l_j, d/dl_k = l_j*delta_ki + l_i*delta_kj
+    (which reduces to 2*l_i on the diagonal).
+
+    Parameters
+    ----------
+    labels_all: numpy ndarray, shape (nstars, nlabels)
+        pivoted label values for all stars
+
+    triu_i, triu_j: numpy ndarray
+        upper-triangle index arrays from np.triu_indices(nlabels)
+
+    Returns
+    -------
+    dlvec_all: numpy ndarray, shape (nstars, nterms, nlabels)
+        derivative of each label vector term wrt each label
+    """
+    nstars, nlabels = labels_all.shape
+    nquad = len(triu_i)
+    dlvec_all = np.zeros((nstars, nlabels+nquad, nlabels))
+    lin = np.arange(nlabels)
+    dlvec_all[:,lin,lin] = 1.
+    quad = nlabels + np.arange(nquad)
+    dlvec_all[:,quad,triu_i] += labels_all[:,triu_j]
+    dlvec_all[:,quad,triu_j] += labels_all[:,triu_i]
+    return dlvec_all
+
+
+def _fit_all_stars(fluxes_piv, sig_all, coeffs, starting_guess,
+                   triu_i, triu_j, n_iter=10, tol=1e-8):
+    """ Fit labels for all stars at once with Levenberg-Marquardt
+
+    Each LM step solves the stacked (nstars, nlabels, nlabels) normal
+    equations in a single np.linalg.solve call, so the inner linear
+    algebra runs as a few big BLAS/LAPACK operations instead of one
+    scipy.optimize.curve_fit per star.
+
+    Parameters
+    ----------
+    fluxes_piv: numpy ndarray, shape (nstars, npix)
+        pivoted flux values
+
+    sig_all: numpy ndarray, shape (nstars, npix)
+        flux errors, incl. the scatter of the model
+
+    coeffs: numpy ndarray, shape (npix, nterms)
+        model coefficients, leading term removed
+
+    starting_guess: numpy ndarray, shape (nlabels,)
+        initial pivoted label values
+
+    Returns
+    -------
+    labels_all: numpy ndarray, shape (nstars, nlabels)
+        best-fit pivoted labels
+
+    covs_all: numpy ndarray, shape (nstars, nlabels, nlabels)
+        covariance matrix of each fit
+
+    converged: numpy ndarray, shape (nstars,)
+        True where the fit converged
+    """
+    nstars = fluxes_piv.shape[0]
+    nlabels = len(starting_guess)
+    labels_all = np.tile(
+            np.array(starting_guess, dtype=float), (nstars, 1))
+    lam = np.ones(nstars) * 1e-3
+    eye = np.eye(nlabels)
+    resid = (fluxes_piv -
+             np.dot(_get_lvec_all(labels_all, triu_i, triu_j),
+                    coeffs.T)) / sig_all
+    chisq = np.einsum('sp,sp->s', resid, resid)
+    converged = np.zeros(nstars, dtype=bool)
+
+    for ii in range(n_iter):
+        dlvec_all = _get_dlvec_all(labels_all, triu_i, triu_j)
+        jac = np.einsum(
+                'pt,stk->spk', coeffs, dlvec_all) / sig_all[:,:,None]
+        ata = np.einsum('spk,spl->skl', jac, jac)
+        atb = np.einsum('spk,sp->sk', jac, resid)
+        # keep an explicit trailing axis so solve treats atb as a
+        # stack of vectors (numpy >= 2.0 no longer broadcasts a 2-D b)
+        step = np.linalg.solve(ata + lam[:,None,None]*eye,
+                               atb[:,:,None])[:,:,0]
+        labels_trial = labels_all + step
+        resid_trial = (fluxes_piv -
+                       np.dot(_get_lvec_all(labels_trial, triu_i, triu_j),
+                              coeffs.T)) / sig_all
+        chisq_trial = np.einsum('sp,sp->s', resid_trial, resid_trial)
+        better = chisq_trial <= chisq
+        accept = better & np.logical_not(converged)
+        labels_all[accept] = labels_trial[accept]
+        resid[accept] = resid_trial[accept]
+        chisq[accept] = chisq_trial[accept]
+        converged = converged | (better & (np.abs(step).max(axis=1) < tol))
+        lam = np.where(better, lam*0.1, lam*10.)
+        if np.all(converged):
+            break
+
+    # covariance of the fit, evaluated at the best-fit labels
+    dlvec_all = _get_dlvec_all(labels_all, triu_i, triu_j)
+    jac = np.einsum('pt,stk->spk', coeffs, dlvec_all) / sig_all[:,:,None]
+    ata = np.einsum('spk,spl->skl', jac, jac)
+    try:
+        covs_all = np.linalg.inv(ata)
+    except np.linalg.LinAlgError:
+        print("singular fit covariance, falling back to curve_fit")
+        covs_all = np.zeros((nstars, nlabels, nlabels))
+        converged = np.zeros(nstars, dtype=bool)
+    return labels_all, covs_all, converged
+
+
+if HAS_NUMBA:
+    @njit(cache=True)
+    def _lvec_one(labels, triu_i, triu_j, out):
+        """ Fill out with the label vector of a single star """
+        nlabels = labels.shape[0]
+        for k in range(nlabels):
+            out[k] = labels[k]
+        for q in range(triu_i.shape[0]):
+            out[nlabels+q] = labels[triu_i[q]] * labels[triu_j[q]]
+
+
+    @njit(cache=True, fastmath=True)
+    def _fit_one_star(flux_piv, sig, coeffs, p0, triu_i, triu_j,
+                      n_iter, tol):
+        """ Levenberg-Marquardt label fit for a single star
+
+        Same normal-equation iteration as _fit_all_stars, written with
+        explicit loops so that numba compiles it to machine code.
+
+        Returns
+        -------
+        labels, cov, converged for this star
+        """
+        npix, nterms = coeffs.shape
+        nlabels = p0.shape[0]
+        nquad = triu_i.shape[0]
+        labels = p0.copy()
+        lvec = np.empty(nterms)
+        dlvec = np.zeros((nterms, nlabels))
+        jac = np.empty((npix, nlabels))
+        resid = np.empty(npix)
+        resid_trial = np.empty(npix)
+        eye = np.eye(nlabels)
+        lam = 1e-3
+
+        _lvec_one(labels, triu_i, triu_j, lvec)
+        chisq = 0.
+        for p in range(npix):
+            m = 0.
+            for t in range(nterms):
+                m += coeffs[p,t] * lvec[t]
+            resid[p] = (flux_piv[p] - m) / sig[p]
+            chisq += resid[p] * resid[p]
+
+        converged = False
+        for ii in range(n_iter):
+            # derivatives of the label vector wrt the labels
+            for t in range(nterms):
+                for k in range(nlabels):
+                    dlvec[t,k] = 0.
+            for k in range(nlabels):
+                dlvec[k,k] = 1.
+            for q in range(nquad):
+                dlvec[nlabels+q, triu_i[q]] += labels[triu_j[q]]
+                dlvec[nlabels+q, triu_j[q]] += labels[triu_i[q]]
+            # weighted jacobian of the model fluxes
+            for p in range(npix):
+                for k in range(nlabels):
+                    v = 0.
+                    for t in range(nterms):
+                        v += coeffs[p,t] * dlvec[t,k]
+                    jac[p,k] = v / sig[p]
+            ata = np.dot(jac.T, jac)
+            atb = np.dot(jac.T, resid)
+            step = np.linalg.solve(ata + lam*eye, atb)
+            labels_trial = labels + step
+            _lvec_one(labels_trial, triu_i, triu_j, lvec)
+            chisq_trial = 0.
+            for p in range(npix):
+                m = 0.
+                for t in range(nterms):
+                    m += coeffs[p,t] * lvec[t]
+                resid_trial[p] = (flux_piv[p] - m) / sig[p]
+                chisq_trial += resid_trial[p] * resid_trial[p]
+            if chisq_trial <= chisq:
+                labels = labels_trial
+                chisq = chisq_trial
+                for p in range(npix):
+                    resid[p] = resid_trial[p]
+                lam = lam * 0.1
+                if np.max(np.abs(step)) < tol:
+                    converged = True
+                    break
+            else:
+                lam = lam * 10.
+
+        # covariance of the fit, evaluated at the best-fit labels
+        for t in range(nterms):
+            for k in range(nlabels):
+                dlvec[t,k] = 0.
+        for k in range(nlabels):
+            dlvec[k,k] = 1.
+        for q in range(nquad):
+            dlvec[nlabels+q, triu_i[q]] += labels[triu_j[q]]
+            dlvec[nlabels+q, triu_j[q]] += labels[triu_i[q]]
+        for p in range(npix):
+            for k in range(nlabels):
+                v = 0.
+                for t in range(nterms):
+                    v += coeffs[p,t] * dlvec[t,k]
+                jac[p,k] = v / sig[p]
+        # a singular matrix would raise inside the prange batch and
+        # abort every star, so flag this one for the curve_fit
+        # fallback instead of inverting
+        ata = np.dot(jac.T, jac)
+        if np.isfinite(ata).all() and np.linalg.det(ata) != 0.:
+            cov = np.linalg.inv(ata)
+        else:
+            cov = np.full((nlabels, nlabels), np.inf)
+            converged = False
+        return labels, cov, converged
+
+
+    @njit(parallel=True)
+    def _fit_all_stars_numba(fluxes_piv, sig_all, coeffs, p0,
+                             triu_i, triu_j, n_iter, tol):
+        """ Fit each star on its own thread; stars are independent """
+        nstars = fluxes_piv.shape[0]
+        nlabels = p0.shape[0]
+        labels_all = np.empty((nstars, nlabels))
+        covs_all = np.empty((nstars, nlabels, nlabels))
+        converged = np.zeros(nstars, dtype=np.bool_)
+        for jj in prange(nstars):
+            labels, cov, conv = _fit_one_star(
+                    fluxes_piv[jj], sig_all[jj], coeffs, p0,
+                    triu_i, triu_j, n_iter, tol)
+            labels_all[jj] = labels
+            covs_all[jj] = cov
+            converged[jj] = conv
+        return labels_all, covs_all, converged
+
+
 def _infer_labels(model, dataset, starting_guess=None):
     """
     Uses the model to solve for labels of the test set.
@@ -73,44 +387,71 @@ def _infer_labels(model, dataset, starting_guess=None):
     fluxes = dataset.test_flux
     ivars = dataset.test_ivar
     nstars = fluxes.shape[0]
-    labels_all = np.zeros((nstars, nlabels))
-    MCM_rotate_all = np.zeros((nstars, coeffs_all.shape[1] - 1,
-                               coeffs_all.shape[1] - 1))
-    errs_all = np.zeros((nstars, nlabels))
     chisq_all = np.zeros(nstars)
     scales = model.scales
 
     if starting_guess is None:
         starting_guess = np.ones(nlabels)
 
-    # print("starting guess: %s" %starting_guess)
-    for jj in range(nstars):
-        flux = fluxes[jj,:]
-        ivar = ivars[jj,:]
-        
-
-        # where the ivar == 0, set the normalized flux to 1 and the sigma to 100
-        bad = ivar == 0
-        flux[bad] = 1.0
-        sigma = np.ones(ivar.shape) * 100.0
-        sigma[~bad] = np.sqrt(1.0 / ivar[~bad])
-
-        flux_piv = flux - coeffs_all[:,0] * 1.  # pivot around the leading term
-        errbar = np.sqrt(sigma**2 + scatters**2)
-        coeffs = np.delete(coeffs_all, 0, axis=1)  # take pivot into account
-        
+    triu_i, triu_j = _triu(nlabels)
+    # take pivot into account; slice instead of np.delete, made
+    # contiguous once since the fit kernels stream through it
+    coeffs = np.ascontiguousarray(coeffs_all[:,1:])
+
+    # where the ivar == 0, take the normalized flux as 1 and the sigma
+    # as 100; the substitution happens in fluxes_piv below so the
+    # dataset arrays are never written to (they may be read-only
+    # memmaps)
+    bad = ivars == 0
+    good = np.logical_not(bad)
+    scatter2 = scatters**2
+    inv_ivar = np.zeros_like(ivars)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.reciprocal(ivars, out=inv_ivar, where=good)
+    # hypot fuses square-add-sqrt into one ufunc pass, with no
+    # intermediate arrays
+    np.sqrt(inv_ivar, out=inv_ivar)
+    sig_all = np.where(good, np.hypot(inv_ivar, scatters[None,:]),
+                       np.hypot(100.0, scatters))
+
+    # pivot around the leading term
+    fluxes_piv = np.where(bad, 1.0, fluxes) - coeffs_all[:,0]
+
+    # fit all stars at once; the stragglers get a curve_fit below
+    if HAS_NUMBA:
+        labels_fit, covs_all, converged = _fit_all_stars_numba(
+                np.ascontiguousarray(fluxes_piv),
+                np.ascontiguousarray(sig_all),
+                np.ascontiguousarray(coeffs),
+                np.array(starting_guess, dtype=float),
+                triu_i, triu_j, 10, 1e-8)
+    else:
+        labels_fit, covs_all, converged = _fit_all_stars(
+                fluxes_piv, sig_all, coeffs, starting_guess, triu_i, triu_j)
+
+    func = _make_func(nlabels)
+    for jj in np.where(np.logical_not(converged))[0]:
+        flux_piv = fluxes_piv[jj,:]
         try:
-            labels, covs = opt.curve_fit(_func, coeffs, flux_piv,
+            labels, covs = opt.curve_fit(func, coeffs, flux_piv,
                                          p0 = starting_guess,
-                                         sigma=errbar, absolute_sigma=True)
+                                         sigma=sig_all[jj,:],
+                                         absolute_sigma=True)
         except RuntimeError:
             print("Error - curve_fit failed")
             labels = np.zeros(starting_guess.shape)-9999.
             covs = np.zeros((len(starting_guess),len(starting_guess)))-9999.
-        chi2 = (flux_piv-_func(coeffs, *labels))**2 * ivar / (1 + ivar * scatters**2)
-        chisq_all[jj] = sum(chi2)
-        labels_all[jj,:] = model.scales * labels + model.pivots
-        errs_all[jj,:] = np.sqrt(covs.diagonal())
+        chi2 = (flux_piv-func(coeffs, *labels))**2 * ivars[jj,:] \
+                / (1 + ivars[jj,:] * scatter2)
+        chisq_all[jj] = chi2.sum()
+        labels_fit[jj,:] = labels
+        covs_all[jj,:,:] = covs
+
+    model_fluxes = np.dot(_get_lvec_all(labels_fit, triu_i, triu_j), coeffs.T)
+    chi2 = (fluxes_piv-model_fluxes)**2 * ivars / (1 + ivars * scatter2)
+    chisq_all[converged] = chi2.sum(axis=1)[converged]
+    labels_all = model.scales * labels_fit + model.pivots
+    errs_all = np.sqrt(np.einsum('sii->si', covs_all))
 
     dataset.set_test_label_vals(labels_all)
     return errs_all, chisq_all
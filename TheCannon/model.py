@@ -107,7 +107,9 @@ class CannonModel(object):
         ax.set_ylim(0.95, 1.05)
         print("Diagnostic plot: fitted 0th order spec w/ cont pix")
         print("Saved as %s.png" % (figname))
-        plt.savefig(figname)
+        # lighter zlib compression encodes the PNG several times
+        # faster for a negligible size cost
+        plt.savefig(figname, pil_kwargs={'compress_level': 3})
         plt.close()
 
 
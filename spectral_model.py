@@ -19,16 +19,13 @@ def draw_spectra(md, ds):
     best_ivars:
         The best-fit test inverse variances
     """
-    coeffs_all, covs, scatters, red_chisqs, pivots, label_vector = model.model
-    nstars = len(dataset.test_SNR)
-    cannon_flux = np.zeros(dataset.test_flux.shape)
-    cannon_ivar = np.zeros(dataset.test_ivar.shape)
-    for i in range(nstars):
-        x = label_vector[:,i,:]
-        spec_fit = np.einsum('ij, ij->i', x, coeffs_all)
-        cannon_flux[i,:] = spec_fit
-        bad = dataset.test_ivar[i,:] == SMALL**2
-        cannon_ivar[i,:][~bad] = 1. / scatters[~bad] ** 2
+    coeffs_all, covs, scatters, red_chisqs, pivots, label_vector = md.model
+    # one contraction over all stars instead of an einsum per star;
+    # optimize='greedy' lets NumPy route the contraction through BLAS
+    cannon_flux = np.einsum('psl,pl->sp', label_vector, coeffs_all,
+                            optimize='greedy')
+    bad = ds.test_ivar == SMALL**2
+    cannon_ivar = np.where(bad, 0., 1. / scatters**2)
     return cannon_flux, cannon_ivar
 
 
@@ -53,9 +50,9 @@ def overlay_spectra(model, dataset):
     lambdas = dataset.wl
     npix = len(lambdas)
     nstars = best_flux.shape[0]
-    pickstars = []
-    for i in range(10):
-        pickstars.append(random.randrange(0, nstars-1))
+    # sample without replacement so no star is plotted (and its file
+    # overwritten) twice
+    pickstars = np.random.choice(nstars, size=min(10, nstars), replace=False)
     for i in pickstars:
         print("Star %s" % i)
         ID = dataset.test_ID[i]
@@ -107,7 +104,9 @@ def overlay_spectra(model, dataset):
         plt.tight_layout()
         filename = "best_fit_spec_Star%s.png" % i
         print("Saved as %s" % filename)
-        fig.savefig(filename)
+        # lighter zlib compression encodes the PNG several times faster
+        # for a negligible size cost
+        fig.savefig(filename, pil_kwargs={'compress_level': 3})
         plt.close(fig)
 
 
@@ -124,23 +123,35 @@ def residuals(cannon_set, dataset):
         original spectra
     """
     print("Stacking spectrum fit residuals")
-    res = dataset.test_fluxes - cannon_set.test_fluxes
-    bad = dataset.test_ivars == SMALL**2
-    err = np.zeros(len(dataset.test_ivars))
-    err = np.sqrt(1. / dataset.test_ivars + 1. / cannon_set.test_ivars)
-    res_norm = res / err
+    res = dataset.test_flux - cannon_set.test_flux
+    bad = dataset.test_ivar == SMALL**2
+    err = np.sqrt(1. / dataset.test_ivar + 1. / cannon_set.test_ivar)
+    # normalize in place; res is not used again unnormalized
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res_norm = np.divide(res, err, out=res)
     res_norm = np.ma.array(res_norm,
                            mask=(np.ones_like(res_norm) *
                                  (np.std(res_norm,axis=0) == 0)))
     res_norm = np.ma.compress_cols(res_norm)
 
+    # these are invariant under the row sort in the label loop below
+    mu = np.mean(res_norm)
+    sigma = np.std(res_norm)
+    star_stds = np.std(res_norm, axis=1)
+    star_stds = star_stds[~np.isnan(star_stds)]
+    pix_stds = np.std(res_norm, axis=0)
+    pix_stds = pix_stds[~np.isnan(pix_stds)]
+
+    # one buffer for the sorted residuals, reused across labels instead
+    # of a fresh fancy-index copy per label
+    sorted_res = np.empty_like(res_norm)
+
     for i in range(len(cannon_set.get_plotting_labels())):
         label_name = cannon_set.get_plotting_labels()[i]
         print("Plotting residuals sorted by %s" % label_name)
         label_vals = cannon_set.tr_label_vals[:,i]
-        sorted_res = res_norm[np.argsort(label_vals)]
-        mu = np.mean(sorted_res.flatten())
-        sigma = np.std(sorted_res.flatten())
+        order = np.argsort(label_vals, kind='stable')
+        np.take(res_norm, order, axis=0, out=sorted_res)
         left, width = 0.1, 0.65
         bottom, height = 0.1, 0.65
         bottom_h = left_h = left+width+0.1
@@ -163,7 +174,7 @@ def residuals(cannon_set, dataset):
                 r"Spectral Residuals Sorted by ${0:s}$".format(label_name))
         axScatter.set_xlabel("Pixels")
         axScatter.set_ylabel(r"$%s$" % label_name)
-        axHisty.hist(np.std(res_norm,axis=1)[~np.isnan(np.std(res_norm, axis=1))], orientation='horizontal', range=[0,2])
+        axHisty.hist(star_stds, orientation='horizontal', range=[0,2])
         axHisty.axhline(y=1, c='k', linewidth=3, label="y=1")
         axHisty.legend(bbox_to_anchor=(0., 0.8, 1., .102),
                        prop={'family':'serif', 'size':'small'})
@@ -175,7 +186,7 @@ def residuals(cannon_set, dataset):
         axHisty.xaxis.set_ticks(np.linspace(start, end, 3))
         axHisty.set_xlabel("Number of Stars")
         axHisty.xaxis.set_label_position("top")
-        axHistx.hist(np.std(res_norm, axis=0)[~np.isnan(np.std(res_norm, axis=0))], range=[0.8,1.1])
+        axHistx.hist(pix_stds, range=[0.8,1.1])
         axHistx.axvline(x=1, c='k', linewidth=3, label="x=1")
         axHistx.set_title("Distribution of Stdev of Pixel Residuals")
         axHistx.set_xlabel("Standard Deviation")
@@ -184,7 +195,7 @@ def residuals(cannon_set, dataset):
         axHistx.yaxis.set_ticks(np.linspace(start, end, 3))
         axHistx.legend()
         filename = "residuals_sorted_by_label_%s.png" % i
-        plt.savefig(filename)
+        plt.savefig(filename, pil_kwargs={'compress_level': 3})
         print("File saved as %s" % filename)
         plt.close()
 